@@ -0,0 +1,249 @@
+import contextlib
+import os
+import queue
+import sys
+import threading
+import time
+from typing import Callable, List, Union
+
+import numpy as np
+
+DEFAULT_FS = 16  # piano roll frames per second
+
+ROLLS_FILE = "rolls.bin"
+INDEX_FILE = "index.bin"
+LOCK_FILE = "archive.lock"
+
+# One record per archived sample. A sample's data block holds one program byte per
+# instrument followed by an (instruments, 128, steps) uint8 piano roll.
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("steps", "<u4"),
+    ("instruments", "<u2"),
+    ("fs", "<u2"),
+    ("batch", "<u4"),
+    ("sample", "<u2"),
+    ("created", "<f8"),
+])
+
+# Frame values are velocities, the high bit marks note onsets so repeated notes stay separate.
+_ONSET = 0x80
+_VELOCITY = 0x7F
+
+
+def midi_to_roll(midi: "pretty_midi.PrettyMIDI", fs: int = DEFAULT_FS) -> np.ndarray:
+    steps = max(1, int(np.ceil(midi.get_end_time() * fs)))
+    roll = np.zeros((len(midi.instruments), 128, steps), dtype=np.uint8)
+    for i, instrument in enumerate(midi.instruments):
+        for note in instrument.notes:
+            start = min(int(round(note.start * fs)), steps - 1)
+            end = max(start + 1, int(round(note.end * fs)))
+            velocity = min(note.velocity, _VELOCITY)
+            roll[i, note.pitch, start:end] = velocity
+            roll[i, note.pitch, start] = velocity | _ONSET
+    return roll
+
+
+def roll_to_midi(roll: np.ndarray, programs: np.ndarray, fs: int = DEFAULT_FS) -> "pretty_midi.PrettyMIDI":
+    import pretty_midi
+
+    midi = pretty_midi.PrettyMIDI()
+    for voice, program in zip(roll, programs):
+        instrument = pretty_midi.Instrument(program=int(program))
+        for pitch, frames in enumerate(voice):
+            active = np.flatnonzero(frames)
+            if len(active) == 0:
+                continue
+            starts = active[((frames[active] & _ONSET) != 0) | (np.diff(active, prepend=-2) != 1)]
+            for start in starts:
+                end = start + 1
+                while end < len(frames) and frames[end] != 0 and (frames[end] & _ONSET) == 0:
+                    end += 1
+                instrument.notes.append(pretty_midi.Note(
+                    velocity=int(frames[start] & _VELOCITY), pitch=pitch, start=start / fs, end=end / fs
+                ))
+        instrument.notes.sort(key=lambda note: note.start)
+        midi.instruments.append(instrument)
+    return midi
+
+
+@contextlib.contextmanager
+def _file_lock(path: str):
+    with open(path, "a+b") as file:
+        if os.name == "nt":
+            import msvcrt
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+class ResultArchive:
+    """Append-only store of generated piano rolls, read back through a memory map.
+
+    Appends hold a lock file, so several processes can share one archive directory.
+    """
+
+    def __init__(self, directory: str, fs: int = DEFAULT_FS):
+        self.directory = directory
+        self.fs = fs
+        self._rolls_path = os.path.join(directory, ROLLS_FILE)
+        self._index_path = os.path.join(directory, INDEX_FILE)
+        self._lock_path = os.path.join(directory, LOCK_FILE)
+        self._lock = threading.Lock()
+        self._map: np.memmap = None
+
+        os.makedirs(directory, exist_ok=True)
+        for path in (self._rolls_path, self._index_path):
+            if not os.path.exists(path):
+                open(path, "wb").close()
+        self._index = self._read_index()
+
+    def _read_index(self) -> np.ndarray:
+        size = os.path.getsize(self._index_path) // INDEX_DTYPE.itemsize
+        return np.fromfile(self._index_path, dtype=INDEX_DTYPE, count=size)
+
+    def __len__(self):
+        return len(self._index)
+
+    @property
+    def index(self) -> np.ndarray:
+        return self._index
+
+    def next_batch(self) -> int:
+        return int(self._index["batch"].max()) + 1 if len(self._index) > 0 else 0
+
+    def refresh(self):
+        with self._lock:
+            self._index = self._read_index()
+
+    def append(self, midis: List["pretty_midi.PrettyMIDI"], batch: int = None) -> List[int]:
+        rolls = [midi_to_roll(midi, self.fs) for midi in midis]
+        programs = [np.array([instrument.program for instrument in midi.instruments], dtype=np.uint8)
+                    for midi in midis]
+
+        with self._lock, _file_lock(self._lock_path):
+            # Drop a torn record left by an interrupted append, new records must stay aligned.
+            size = os.path.getsize(self._index_path)
+            if size % INDEX_DTYPE.itemsize != 0:
+                print("[Archive]: Dropping incomplete index record.")
+                os.truncate(self._index_path, size - size % INDEX_DTYPE.itemsize)
+            # Other processes may have appended since the index was last read.
+            self._index = self._read_index()
+            if batch is None:
+                batch = self.next_batch()
+            records = np.zeros(len(midis), dtype=INDEX_DTYPE)
+            # Data is written before the index so an interrupted append never indexes missing data.
+            with open(self._rolls_path, "ab") as file:
+                offset = file.seek(0, os.SEEK_END)
+                for i, (roll, program) in enumerate(zip(rolls, programs)):
+                    records[i] = (offset, roll.shape[2], roll.shape[0], self.fs, batch, i, time.time())
+                    file.write(program.tobytes())
+                    file.write(roll.tobytes())
+                    offset += program.nbytes + roll.nbytes
+            with open(self._index_path, "ab") as file:
+                file.write(records.tobytes())
+
+            first = len(self._index)
+            self._index = np.concatenate([self._index, records])
+            return list(range(first, len(self._index)))
+
+    def _mapped(self, end: int) -> np.memmap:
+        if self._map is None or len(self._map) < end:
+            self._map = np.memmap(self._rolls_path, dtype=np.uint8, mode="r")
+        return self._map
+
+    def piano_roll(self, item: int) -> np.ndarray:
+        record = self._index[item]
+        start = int(record["offset"]) + int(record["instruments"])
+        size = int(record["instruments"]) * 128 * int(record["steps"])
+        with self._lock:
+            data = self._mapped(start + size)
+        return data[start:start + size].reshape(int(record["instruments"]), 128, int(record["steps"]))
+
+    def programs(self, item: int) -> np.ndarray:
+        record = self._index[item]
+        start = int(record["offset"])
+        with self._lock:
+            data = self._mapped(start + int(record["instruments"]))
+        return data[start:start + int(record["instruments"])]
+
+    def to_midi(self, item: int) -> "pretty_midi.PrettyMIDI":
+        return roll_to_midi(self.piano_roll(item), self.programs(item), int(self._index[item]["fs"]))
+
+    def write_midi(self, item: int, path: str) -> str:
+        self.to_midi(item).write(path)
+        return path
+
+
+class ArchiveWriter:
+    """Persists generated batches into a ResultArchive on a background thread."""
+
+    def __init__(self, archive: "ResultArchive"):
+        self.archive = archive
+        self.running = False
+        self._queue = queue.Queue()
+        self.worker = threading.Thread(target=self._work)
+        self.worker.daemon = True
+
+    def submit(self, midis: List["pretty_midi.PrettyMIDI"],
+               callback: Union[Callable[[List[int]], None], None] = None):
+        """The callback receives the archive ids of the stored samples, an empty list if storing failed."""
+        self._queue.put((midis, callback))
+
+    def _work(self):
+        print("[Archive]: Writing to", self.archive.directory)
+        item = self._queue.get()
+        while item is not None:
+            midis, callback = item
+            ids = []
+            try:
+                ids = self.archive.append(midis)
+                print("[Archive]: Stored", len(ids), "samples.")
+            except Exception as e:
+                print("[Archive]: Storing samples failed:", e)
+            if callback is not None:
+                try:
+                    callback(ids)
+                except Exception as e:
+                    print("[Archive]: Callback failed:", e)
+            item = self._queue.get()
+        print("[Archive]: Exited.")
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self.worker.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._queue.put(None)
+
+    def join(self):
+        self.worker.join()
+
+
+if __name__ == '__main__':
+    result_archive = ResultArchive(sys.argv[1] if len(sys.argv) > 1 else "archive")
+    if len(sys.argv) > 3:
+        print("Wrote", result_archive.write_midi(int(sys.argv[2]), sys.argv[3]))
+    else:
+        for index, entry in enumerate(result_archive.index):
+            print(f"[{index}]: batch {entry['batch']} sample {entry['sample']}, "
+                  f"{entry['steps'] / entry['fs']:.1f}s, {time.ctime(entry['created'])}")
@@ -1,68 +1,169 @@
+import gc
 import math
+import os
+import time
 
 import parallel
 
 STATE_EMPTY = 0
 STATE_LOADED = 1
+STATE_IDLE = 2  # model was unloaded after being idle, it is reloaded on the next generation
 
 CMD_LOAD = (0, 1)  # (folderpath) -> None
-CMD_STATE = (2, 3)  # () -> STATE
+CMD_STATE = (2, 3)  # ([opt] detailed=False) -> STATE or (STATE, rss_bytes)
 CMD_GENERATE = (4, 5)  # (pretty_midi.PrettyMIDI, batch_count) -> List[pretty_midi.PrettyMIDI]
 CMD_EXIT = (6, 7)  # () -> bool
 
 
+INTRA_OP_THREADS_ENV = "COCONET_INTRA_OP_THREADS"
+INTER_OP_THREADS_ENV = "COCONET_INTER_OP_THREADS"
+IDLE_TIMEOUT_ENV = "COCONET_IDLE_TIMEOUT"
+
+
+def _configure_threads(intra_op_threads: int, inter_op_threads: int):
+    if intra_op_threads <= 0 and inter_op_threads <= 0:
+        return
+
+    # Has to happen before TensorFlow creates its first session.
+    if intra_op_threads > 0:
+        os.environ["TF_NUM_INTRAOP_THREADS"] = str(intra_op_threads)
+        os.environ["OMP_NUM_THREADS"] = str(intra_op_threads)
+    if inter_op_threads > 0:
+        os.environ["TF_NUM_INTEROP_THREADS"] = str(inter_op_threads)
+
+    import tensorflow as tf
+    if intra_op_threads > 0:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads > 0:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+
+def _close_model(model):
+    # TFGenerator wraps a CoconetSampleGraph, which builds into the default graph
+    # and only creates its session on the first generation.
+    import tensorflow.compat.v1 as tf
+
+    session = model.sampler.sess
+    if session is not None:
+        session.close()
+        model.sampler.sess = None
+    else:
+        print("[Coconet]: No session was created, resetting graph only.")
+    tf.reset_default_graph()
+    gc.collect()
+
+
 class CoconetJob(parallel.ParallelJob):
-    def __init__(self):
+    def __init__(self, intra_op_threads: int = 0, inter_op_threads: int = 0, idle_timeout: float = None):
+        """Thread counts of 0 keep TensorFlow's defaults, an idle_timeout of None never unloads the model."""
         super().__init__()
         self._model = None
+        self._model_path = None
+        self._last_used = 0.0
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.idle_timeout = idle_timeout
+
+    @classmethod
+    def from_environment(cls) -> "CoconetJob":
+        idle_timeout = os.environ.get(IDLE_TIMEOUT_ENV)
+        return cls(
+            intra_op_threads=int(os.environ.get(INTRA_OP_THREADS_ENV, 0)),
+            inter_op_threads=int(os.environ.get(INTER_OP_THREADS_ENV, 0)),
+            idle_timeout=float(idle_timeout) if idle_timeout else None
+        )
+
+    def _load(self, path: str):
+        self._unload()
+        print("[Coconet]: Loading", path)
+        from magenta.models.coconet.coconet_sample import TFGenerator
+        self._model = TFGenerator(path)
+        self._model_path = path
+        self._last_used = time.time()
+        print("[Coconet]: Loaded", path)
+
+    def _unload(self):
+        if self._model is not None:
+            print("[Coconet]: Unloading", self._model_path)
+            _close_model(self._model)
+            self._model = None
+
+    def _state(self) -> int:
+        if self._model is not None:
+            return STATE_LOADED
+        if self._model_path is not None:
+            return STATE_IDLE
+        return STATE_EMPTY
 
     def work(self, receiver: parallel.ChannelActor):
         import pretty_midi
+        import psutil
+
+        _configure_threads(self.intra_op_threads, self.inter_op_threads)
+        process = psutil.Process()
 
-        state = STATE_EMPTY
         action = receiver.invoked(*CMD_EXIT)
         while not action:
             action = receiver.invoked(*CMD_LOAD)
             if action:
-                if self._model is not None:
-                    del self._model
-                    state = STATE_EMPTY
-
-                print("[Coconet]: Loading", action.parameter)
-                from magenta.models.coconet.coconet_sample import TFGenerator
-                self._model = TFGenerator(action.parameter)
-                state = STATE_LOADED
-                action.finish()
-                print("[Coconet]: Loaded", action.parameter)
+                try:
+                    self._load(action.parameter)
+                    action.finish()
+                except Exception as e:
+                    print("[Coconet]: Loading failed:", e)
+                    self._model = None
+                    self._model_path = None
+                    action.fail(f"Loading failed: {e}")
 
             action = receiver.invoked(*CMD_GENERATE)
             if action:
-                if self._model is None:
+                if self._model_path is None:
                     action.fail("No model is loaded.")
-                elif not isinstance(action.parameter[0], pretty_midi.PrettyMIDI):
+                elif not isinstance(action.parameter, (tuple, list)) or len(action.parameter) != 2 \
+                        or not isinstance(action.parameter[0], pretty_midi.PrettyMIDI) \
+                        or not isinstance(action.parameter[1], int):
                     action.fail("Invalid parameter.")
                 else:
-                    print("[Coconet]: Generating voices...")
-                    midi_in: pretty_midi.PrettyMIDI = action.parameter[0]
-                    time = int(math.ceil(midi_in.get_end_time())) * 4
-
-                    print("[Coconet]: Generating for", time, "steps")
-                    output = self._model.run_generation(
-                        gen_batch_size=action.parameter[1],
-                        piece_length=time,
-                        total_gibbs_steps=96,
-                        temperature=0.99
-                    )
-                    action.finish(output)
-                    print("[Coconet]: Generated voices.")
+                    try:
+                        if self._model is None:
+                            self._load(self._model_path)
+
+                        print("[Coconet]: Generating voices...")
+                        midi_in: pretty_midi.PrettyMIDI = action.parameter[0]
+                        time_steps = int(math.ceil(midi_in.get_end_time())) * 4
+
+                        print("[Coconet]: Generating for", time_steps, "steps")
+                        output = self._model.run_generation(
+                            gen_batch_size=action.parameter[1],
+                            piece_length=time_steps,
+                            total_gibbs_steps=96,
+                            temperature=0.99
+                        )
+                        self._last_used = time.time()
+                        action.finish(output)
+                        print("[Coconet]: Generated voices.")
+                    except Exception as e:
+                        print("[Coconet]: Generating failed:", e)
+                        action.fail(f"Generating failed: {e}")
 
             action = receiver.invoked(*CMD_STATE)
             if action:
+                state = self._state()
                 print("[Coconet]: State requested:", state)
-                action.finish(state)
+                if action.parameter:
+                    action.finish((state, process.memory_info().rss))
+                else:
+                    action.finish(state)
                 print("[Coconet]: State sent.")
+
+            if self._model is not None and self.idle_timeout is not None \
+                    and time.time() - self._last_used > self.idle_timeout:
+                print("[Coconet]: Idle for", self.idle_timeout, "seconds.")
+                self._unload()
+
             action = receiver.invoked(*CMD_EXIT)
 
+        self._unload()
         print("[Coconet]: Exiting.")
         action.finish(True)
 
@@ -1,4 +1,4 @@
-from typing import Callable, Dict
+from typing import Callable, Dict, Union
 
 from PyQt5 import QtWidgets
 from PyQt5.QtCore import QSettings
@@ -10,7 +10,10 @@ import easyprocess
 import time
 import watchdog.observers
 import watchdog.events
+import archive
 import coconet
+import parallel
+import server
 import pretty_midi as midi
 import mido
 import sys
@@ -18,8 +21,9 @@ import sys
 EDITOR_PATH = r"D:\Temp\MidiEditor\MidiEditor.exe"
 
 GUI_THREAD: qt.QtThread = None
-COCONET_PROCESS: coconet.CoconetJob = None
+COCONET_PROCESS: Union[coconet.CoconetJob, server.CoconetClient] = None
 EDITOR_OUTPUT_PROCESS: "Editor" = None
+ARCHIVE_WRITER: archive.ArchiveWriter = None
 MIDI_IN: str = None
 MIDI_OUT: str = None
 
@@ -27,6 +31,12 @@ EDITOR_KEY_PORT_IN = "in_port"
 EDITOR_KEY_PORT_OUT = "out_port"
 EDITOR_KEY_CONNECT_PORTS = "thru"
 
+COCONET_SERVER_ENV = "COCONET_SERVER"
+
+BATCH_SIZE_ENV = "COCONET_BATCH_SIZE"
+
+ARCHIVE_PATH = "archive"
+
 
 def get_int_from_args(index: int) -> int:
     if len(sys.argv) > index:
@@ -37,6 +47,10 @@ def get_int_from_args(index: int) -> int:
     return -1
 
 
+def get_batch_size() -> int:
+    return max(1, int(os.environ.get(BATCH_SIZE_ENV, 1)))
+
+
 def get_midi_input() -> str:
     names = mido.get_input_names()
     if len(names) == 0:
@@ -203,24 +217,43 @@ def on_change(path: str):
             *qt.CMD_OPEN_PROGRESS, ("Generating", "Generating voices...", (0, 0))
         )
 
-        print("[FileObserver]: Sending MIDI to Coconet...")
-        midi_in = midi.PrettyMIDI(path)
-        result = COCONET_PROCESS.channel.sender.invoke(
-            *coconet.CMD_GENERATE, (midi_in, 1)
-        )
+        error = None
+        try:
+            print("[FileObserver]: Sending MIDI to Coconet...")
+            midi_in = midi.PrettyMIDI(path)
+            result = COCONET_PROCESS.channel.sender.invoke_failing(
+                *coconet.CMD_GENERATE, (midi_in, get_batch_size())
+            )
+
+            print("[FileObserver]: Archiving", len(result), "samples...")
+            ARCHIVE_WRITER.submit(result)
+
+            print("[FileObserver]: Checking for open output editors...")
+            close_editor_output()
 
-        print("[FileObserver]: Checking for open output editors...")
-        close_editor_output()
+            print("[FileObserver]: Saving results...")
+            file = os.path.join(os.getcwd(), "batch.mid")
+            result[0].write(file)
 
-        print("[FileObserver]: Saving results...")
-        file = os.path.join(os.getcwd(), "batch.mid")
-        result[0].write(file)
+            print("[FileObserver]: Opening editor...")
+            run_editor_output(file)
+        except parallel.CommandException as e:
+            print("[FileObserver]: Generating failed:", e.msg)
+            error = e.msg
+        finally:
+            print("[FileObserver]: Closing Progressdialog...")
+            GUI_THREAD.channel.sender.invoke(*qt.CMD_CLOSE_PROGRESS)
 
-        print("[FileObserver]: Opening editor...")
-        run_editor_output(file)
+        if error is not None:
+            GUI_THREAD.channel.sender.invoke(*qt.CMD_SHOW_MSG, ("Error", f"Generating voices failed: {error}"))
 
-        print("[FileObserver]: Closing Progressdialog...")
-        GUI_THREAD.channel.sender.invoke(*qt.CMD_CLOSE_PROGRESS)
+
+def create_coconet() -> Union[coconet.CoconetJob, server.CoconetClient]:
+    address = os.environ.get(COCONET_SERVER_ENV)
+    if address:
+        print("[main]: Using shared Coconet-Server at", address)
+        return server.CoconetClient(server.parse_address(address))
+    return coconet.CoconetJob.from_environment()
 
 
 def create_empty_mid(name: str) -> str:
@@ -271,20 +304,25 @@ def run_editor_output(file):
 
 
 def main():
-    global GUI_THREAD, COCONET_PROCESS
+    global GUI_THREAD, COCONET_PROCESS, ARCHIVE_WRITER
 
     print("[main]: Starting Coconet-Process...")
-    COCONET_PROCESS = coconet.CoconetJob()
+    COCONET_PROCESS = create_coconet()
     COCONET_PROCESS.start()
 
     print("[main]: Loading model in Coconet...")
     COCONET_PROCESS.channel.sender.invoke_failing(*coconet.CMD_LOAD, "pretrained")
 
     print("[main]: Checking state of Coconet...")
-    if not COCONET_PROCESS.channel.sender.invoke(*coconet.CMD_STATE) == coconet.STATE_LOADED:
+    # An idle model is reloaded on the next generation, so it counts as loaded.
+    if COCONET_PROCESS.channel.sender.invoke(*coconet.CMD_STATE) not in (coconet.STATE_LOADED, coconet.STATE_IDLE):
         print("[main]: Invalid state.")
         exit(-1)
 
+    print("[main]: Starting ArchiveWriter...")
+    ARCHIVE_WRITER = archive.ArchiveWriter(archive.ResultArchive(os.path.join(os.getcwd(), ARCHIVE_PATH)))
+    ARCHIVE_WRITER.start()
+
     print("[main]: Starting MidiEditor...")
     editor = run_editor_input()
 
@@ -311,6 +349,10 @@ def main():
     observer.stop()
     observer.join()
 
+    print("[main]: Shutting down ArchiveWriter...")
+    ARCHIVE_WRITER.stop()
+    ARCHIVE_WRITER.join()
+
     editor.restore_settings()
 
 
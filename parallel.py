@@ -10,6 +10,9 @@ class CommandException(Exception):
         self.cmd = cmd
         self.msg = msg
 
+    def __reduce__(self):
+        return CommandException, (self.cmd, self.msg)
+
 
 class CommandAction:
     def __init__(self, owner: "ChannelActor", cmd, parameter, return_cmd):
@@ -0,0 +1,497 @@
+import io
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple, Union
+
+import coconet
+import parallel
+
+Address = Union[str, Tuple[str, int]]
+
+DEFAULT_ADDRESS: Address = ("127.0.0.1", 5917)
+
+# Frame header: request id, command, payload length.
+_HEADER = struct.Struct("!IHI")
+MAX_PAYLOAD = 64 * 1024 * 1024
+
+# Payloads are tagged values, only the types used by the coconet commands can be sent.
+_TAG_NONE = 0
+_TAG_BOOL = 1
+_TAG_INT = 2
+_TAG_STR = 3
+_TAG_MIDI = 4  # standard MIDI file bytes
+_TAG_TUPLE = 5
+_TAG_LIST = 6
+_TAG_ERROR = 7  # parallel.CommandException as command and message
+_MAX_DEPTH = 4
+
+_LENGTH = struct.Struct("!I")
+_INT = struct.Struct("!q")
+_CMD = struct.Struct("!H")
+
+_COMMANDS = {
+    command[0]: command for command in (coconet.CMD_LOAD, coconet.CMD_STATE, coconet.CMD_GENERATE, coconet.CMD_EXIT)
+}
+
+
+def _result_cmd(cmd: int) -> int:
+    # Unknown commands are answered on the conventional result id.
+    command = _COMMANDS.get(cmd)
+    return command[1] if command is not None else cmd + 1
+
+
+def _valid_parameter(command: Tuple[int, int], value: any) -> bool:
+    if command == coconet.CMD_LOAD:
+        return isinstance(value, str) and len(value) > 0
+    if command == coconet.CMD_STATE:
+        return value is None or isinstance(value, bool)
+    if command == coconet.CMD_GENERATE:
+        if not isinstance(value, (tuple, list)) or len(value) != 2:
+            return False
+        import pretty_midi
+        count = value[1]
+        return isinstance(value[0], pretty_midi.PrettyMIDI) \
+            and isinstance(count, int) and not isinstance(count, bool) and count > 0
+    return True
+
+
+def parse_address(text: str) -> Address:
+    host, _, port = text.rpartition(":")
+    if host and port.isdigit():
+        return host, int(port)
+    return text
+
+
+def _create_socket(address: Address) -> socket.socket:
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _encode_bytes(tag: int, data: bytes) -> bytes:
+    return bytes([tag]) + _LENGTH.pack(len(data)) + data
+
+
+def encode_value(value: any) -> bytes:
+    if value is None:
+        return bytes([_TAG_NONE])
+    if isinstance(value, bool):
+        return bytes([_TAG_BOOL, value])
+    if isinstance(value, int):
+        return bytes([_TAG_INT]) + _INT.pack(value)
+    if isinstance(value, str):
+        return _encode_bytes(_TAG_STR, value.encode("utf-8"))
+    if isinstance(value, parallel.CommandException):
+        message = str(value.msg).encode("utf-8")
+        return bytes([_TAG_ERROR]) + _CMD.pack(value.cmd) + _LENGTH.pack(len(message)) + message
+    if isinstance(value, (tuple, list)):
+        tag = _TAG_TUPLE if isinstance(value, tuple) else _TAG_LIST
+        return bytes([tag]) + _LENGTH.pack(len(value)) + b"".join(encode_value(item) for item in value)
+
+    import pretty_midi
+    if isinstance(value, pretty_midi.PrettyMIDI):
+        buffer = io.BytesIO()
+        value.write(buffer)
+        return _encode_bytes(_TAG_MIDI, buffer.getvalue())
+    raise TypeError(f"Cannot send values of type {type(value).__name__}.")
+
+
+class _Decoder:
+    def __init__(self, payload: bytes):
+        self._payload = payload
+        self._offset = 0
+
+    def _take(self, size: int) -> bytes:
+        if self._offset + size > len(self._payload):
+            raise ValueError("Truncated payload.")
+        data = self._payload[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def _bytes(self) -> bytes:
+        return self._take(_LENGTH.unpack(self._take(_LENGTH.size))[0])
+
+    def value(self, depth: int = 0) -> any:
+        if depth > _MAX_DEPTH:
+            raise ValueError("Payload nested too deeply.")
+        tag = self._take(1)[0]
+        if tag == _TAG_NONE:
+            return None
+        if tag == _TAG_BOOL:
+            return self._take(1)[0] != 0
+        if tag == _TAG_INT:
+            return _INT.unpack(self._take(_INT.size))[0]
+        if tag == _TAG_STR:
+            return self._bytes().decode("utf-8")
+        if tag == _TAG_ERROR:
+            cmd = _CMD.unpack(self._take(_CMD.size))[0]
+            return parallel.CommandException(cmd, self._bytes().decode("utf-8"))
+        if tag == _TAG_TUPLE or tag == _TAG_LIST:
+            count = _LENGTH.unpack(self._take(_LENGTH.size))[0]
+            items = [self.value(depth + 1) for _ in range(count)]
+            return tuple(items) if tag == _TAG_TUPLE else items
+        if tag == _TAG_MIDI:
+            import pretty_midi
+            data = self._bytes()
+            try:
+                return pretty_midi.PrettyMIDI(io.BytesIO(data))
+            except Exception as e:
+                raise ValueError(f"Invalid MIDI data: {e}") from e
+        raise ValueError(f"Unknown value tag {tag}.")
+
+    def finish(self, value: any) -> any:
+        if self._offset != len(self._payload):
+            raise ValueError("Trailing bytes in payload.")
+        return value
+
+
+def decode_value(payload: bytes) -> any:
+    decoder = _Decoder(payload)
+    return decoder.finish(decoder.value())
+
+
+def send_frame(sock: socket.socket, lock: threading.Lock, request_id: int, cmd: int, value: any):
+    payload = encode_value(value)
+    with lock:
+        sock.sendall(_HEADER.pack(request_id, cmd, len(payload)) + payload)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> Union[bytes, None]:
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            return None
+        buffer.extend(chunk)
+    return bytes(buffer)
+
+
+def recv_frame(sock: socket.socket) -> Union[Tuple[int, int, any], None]:
+    header = _recv_exact(sock, _HEADER.size)
+    if header is None:
+        return None
+    request_id, cmd, size = _HEADER.unpack(header)
+    if size > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {size} bytes exceeds limit.")
+    payload = _recv_exact(sock, size)
+    if payload is None:
+        return None
+    return request_id, cmd, decode_value(payload)
+
+
+def _close_socket(sock: socket.socket):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    sock.close()
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket, server: "CoconetServer"):
+        self._socket = sock
+        self._lock = threading.Lock()
+        self._server = server
+        self._worker = threading.Thread(target=self._work)
+        self._worker.daemon = True
+
+    def start(self):
+        self._worker.start()
+
+    def close(self):
+        _close_socket(self._socket)
+
+    def reply(self, request_id: int, cmd: int, value: any):
+        try:
+            try:
+                send_frame(self._socket, self._lock, request_id, cmd, value)
+            except TypeError as e:
+                send_frame(self._socket, self._lock, request_id, cmd, parallel.CommandException(cmd, str(e)))
+        except OSError:
+            print("[Server]: Client disconnected, dropping reply.")
+
+    def _work(self):
+        try:
+            frame = recv_frame(self._socket)
+            while frame is not None:
+                self._server.submit(self, *frame)
+                frame = recv_frame(self._socket)
+        except ValueError as e:
+            print("[Server]: Invalid frame from client:", e)
+        except OSError:
+            pass
+        self.close()
+        self._server.detach(self)
+
+
+class CoconetServer:
+    """Shares one resident CoconetJob between any number of socket clients.
+
+    Requests from all connections are queued and executed one at a time on the job,
+    replies are routed back to the connection and request id they came from.
+    """
+
+    def __init__(self, address: Address = DEFAULT_ADDRESS, job: parallel.ParallelJob = None):
+        self.address = address
+        self._job = job if job is not None else coconet.CoconetJob.from_environment()
+        self._listener: socket.socket = None
+        self._requests = queue.Queue()
+        self._connections: List["_Connection"] = []
+        self._lock = threading.Lock()
+        self._loaded = None
+        self._running = False
+        self._acceptor = threading.Thread(target=self._accept)
+        self._acceptor.daemon = True
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self):
+        if self.running:
+            return
+        print("[Server]: Starting Coconet-Process...")
+        self._job.start()
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = _create_socket(self.address)
+        if not isinstance(self.address, str):
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen()
+        self._listener.settimeout(0.1)
+        if not isinstance(self.address, str):
+            self.address = self._listener.getsockname()[:2]
+
+        self._running = True
+        self._dispatcher.start()
+        self._acceptor.start()
+        print("[Server]: Listening on", self.address)
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while self.running:
+                time.sleep(0.1)
+        except KeyboardInterrupt:
+            pass
+        self.shutdown()
+
+    def shutdown(self):
+        if not self.running:
+            return
+        print("[Server]: Shutting down...")
+        self._running = False
+        self._acceptor.join()
+        self._listener.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+
+        with self._lock:
+            connections = list(self._connections)
+        for connection in connections:
+            connection.close()
+
+        self._requests.put(None)
+        self._dispatcher.join()
+
+        print("[Server]: Shutting down Coconet...")
+        if self._job.is_alive():
+            self._job.shutdown()
+        else:
+            self._job.join()
+        print("[Server]: Exited.")
+
+    def submit(self, connection: "_Connection", request_id: int, cmd: int, value: any):
+        self._requests.put((connection, request_id, cmd, value))
+
+    def detach(self, connection: "_Connection"):
+        with self._lock:
+            if connection in self._connections:
+                self._connections.remove(connection)
+                print("[Server]: Client disconnected,", len(self._connections), "remaining.")
+
+    def _accept(self):
+        while self.running:
+            try:
+                sock, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sock.setblocking(True)
+            connection = _Connection(sock, self)
+            with self._lock:
+                self._connections.append(connection)
+                print("[Server]: Client connected,", len(self._connections), "active.")
+            connection.start()
+
+    def _dispatch(self):
+        item = self._requests.get()
+        while item is not None:
+            connection, request_id, cmd, value = item
+            connection.reply(request_id, *self._execute(cmd, value))
+            item = self._requests.get()
+
+    def _execute(self, cmd: int, value: any) -> Tuple[int, any]:
+        command = _COMMANDS.get(cmd)
+        if command is None:
+            return _result_cmd(cmd), parallel.CommandException(cmd, "Unknown command.")
+        if command == coconet.CMD_EXIT:
+            # A client exiting only detaches, the shared model stays resident.
+            return command[1], True
+        if not _valid_parameter(command, value):
+            return command[1], parallel.CommandException(cmd, "Invalid parameter.")
+        if not self._job.is_alive():
+            return command[1], parallel.CommandException(cmd, "Coconet process is not running.")
+        if command == coconet.CMD_LOAD and self._loaded is not None and value == self._loaded:
+            print("[Server]: Model already loaded:", value)
+            return command[1], None
+
+        result = self._invoke(command, value)
+        if command == coconet.CMD_LOAD:
+            self._loaded = value if not isinstance(result, parallel.CommandException) else None
+        return command[1], result
+
+    def _invoke(self, command: Tuple[int, int], value: any) -> any:
+        # Polls instead of blocking, so requests fail if the job dies while handling them.
+        sender = self._job.channel.sender
+        sender.send(command[0], value)
+        received, result = sender.received_cmd_value(command[1])
+        while not received:
+            if not self._job.is_alive():
+                print("[Server]: Coconet process exited.")
+                self._loaded = None
+                return parallel.CommandException(command[0], "Coconet process exited.")
+            time.sleep(0.01)
+            received, result = sender.received_cmd_value(command[1])
+        return result
+
+
+class _RequestQueue:
+    """Send side of a per-thread ChannelActor, every put is sent as one request frame."""
+
+    def __init__(self, channel: "SocketChannel", replies: queue.Queue):
+        self._channel = channel
+        self._replies = replies
+
+    def put(self, item: Tuple[int, any]):
+        self._channel.request(item[0], item[1], self._replies)
+
+    def put_nowait(self, item: Tuple[int, any]):
+        self.put(item)
+
+
+class SocketChannel:
+    """CommandChannel counterpart whose receiving actor lives in a CoconetServer.
+
+    Every thread gets its own sender, replies are routed back to it by request id.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self._socket = sock
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending: Dict[int, Tuple[int, queue.Queue]] = dict()
+        self._request_id = 0
+        self._closed = False
+        self._senders = threading.local()
+        self._reader = threading.Thread(target=self._read)
+        self._reader.daemon = True
+
+    @property
+    def sender(self) -> "parallel.ChannelActor":
+        sender = getattr(self._senders, "actor", None)
+        if sender is None:
+            replies = queue.Queue()
+            sender = parallel.ChannelActor(_RequestQueue(self, replies), replies)
+            self._senders.actor = sender
+        return sender
+
+    def start(self):
+        self._reader.start()
+
+    def close(self):
+        _close_socket(self._socket)
+        self._reader.join()
+
+    def request(self, cmd: int, value: any, replies: queue.Queue):
+        with self._pending_lock:
+            if self._closed:
+                replies.put((_result_cmd(cmd), parallel.CommandException(cmd, "Not connected to server.")))
+                return
+            self._request_id = (self._request_id + 1) & 0xFFFFFFFF
+            request_id = self._request_id
+            self._pending[request_id] = (cmd, replies)
+
+        try:
+            send_frame(self._socket, self._lock, request_id, cmd, value)
+        except TypeError as e:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            replies.put((_result_cmd(cmd), parallel.CommandException(cmd, str(e))))
+        except OSError as e:
+            self._disconnect(f"Connection to server lost: {e}")
+
+    def _disconnect(self, reason: str):
+        with self._pending_lock:
+            self._closed = True
+            pending = list(self._pending.values())
+            self._pending.clear()
+        if pending:
+            print("[Client]:", reason)
+        for cmd, replies in pending:
+            replies.put((_result_cmd(cmd), parallel.CommandException(cmd, reason)))
+
+    def _read(self):
+        reason = "Connection to server closed."
+        try:
+            frame = recv_frame(self._socket)
+            while frame is not None:
+                request_id, cmd, value = frame
+                with self._pending_lock:
+                    pending = self._pending.pop(request_id, None)
+                if pending is not None:
+                    pending[1].put((cmd, value))
+                frame = recv_frame(self._socket)
+        except (OSError, ValueError) as e:
+            reason = f"Connection to server lost: {e}"
+        self._disconnect(reason)
+
+
+class CoconetClient:
+    """Drop-in replacement for coconet.CoconetJob that uses a shared CoconetServer."""
+
+    def __init__(self, address: Address = DEFAULT_ADDRESS):
+        self.address = address
+        self._channel: SocketChannel = None
+
+    @property
+    def channel(self) -> "SocketChannel":
+        return self._channel
+
+    def start(self):
+        print("[Client]: Connecting to", self.address)
+        sock = _create_socket(self.address)
+        sock.connect(self.address)
+        self._channel = SocketChannel(sock)
+        self._channel.start()
+
+    def shutdown(self):
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+
+
+if __name__ == '__main__':
+    CoconetServer(parse_address(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_ADDRESS).serve_forever()
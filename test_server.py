@@ -0,0 +1,161 @@
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import pretty_midi
+
+import coconet
+import parallel
+import server
+
+CRASH_BATCH_COUNT = 99
+SLOW_BATCH_COUNT = 50
+
+
+class FakeJob(parallel.ParallelJob):
+    """Answers the coconet commands without a model, generating copies of the input."""
+
+    def work(self, receiver: parallel.ChannelActor):
+        loaded = None
+        action = receiver.invoked(*coconet.CMD_EXIT)
+        while not action:
+            action = receiver.invoked(*coconet.CMD_LOAD)
+            if action:
+                loaded = action.parameter
+                action.finish()
+
+            action = receiver.invoked(*coconet.CMD_GENERATE)
+            if action:
+                midi_in, count = action.parameter
+                if count == CRASH_BATCH_COUNT:
+                    os._exit(1)
+                if count == SLOW_BATCH_COUNT:
+                    time.sleep(1)
+                action.finish([midi_in] * count)
+
+            action = receiver.invoked(*coconet.CMD_STATE)
+            if action:
+                action.finish(coconet.STATE_LOADED if loaded is not None else coconet.STATE_EMPTY)
+
+            time.sleep(0.001)
+            action = receiver.invoked(*coconet.CMD_EXIT)
+        action.finish(True)
+
+    def shutdown(self):
+        self.channel.sender.invoke(*coconet.CMD_EXIT)
+        self.join()
+
+
+def make_midi(program: int) -> pretty_midi.PrettyMIDI:
+    midi = pretty_midi.PrettyMIDI()
+    instrument = pretty_midi.Instrument(program=program)
+    instrument.notes.append(pretty_midi.Note(velocity=80, pitch=60, start=0, end=1))
+    midi.instruments.append(instrument)
+    return midi
+
+
+def invoke_with_timeout(sender: parallel.ChannelActor, cmd, value=None, timeout: float = 10) -> any:
+    result = []
+    worker = threading.Thread(target=lambda: result.append(sender.invoke(*cmd, value)))
+    worker.daemon = True
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        raise AssertionError(f"Command {cmd} did not return within {timeout} seconds.")
+    return result[0]
+
+
+class ServerTest(unittest.TestCase):
+    address: server.Address = ("127.0.0.1", 0)
+
+    def setUp(self):
+        self.server = server.CoconetServer(self.address, FakeJob())
+        self.server.start()
+        self.client = server.CoconetClient(self.server.address)
+        self.client.start()
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.server.shutdown()
+
+    def test_load_and_state(self):
+        sender = self.client.channel.sender
+        self.assertEqual(sender.invoke(*coconet.CMD_STATE), coconet.STATE_EMPTY)
+        self.assertIsNone(sender.invoke_failing(*coconet.CMD_LOAD, "pretrained"))
+        self.assertIsNone(sender.invoke_failing(*coconet.CMD_LOAD, "pretrained"))
+        self.assertEqual(sender.invoke(*coconet.CMD_STATE), coconet.STATE_LOADED)
+
+    def test_concurrent_invokes_are_routed(self):
+        results = dict()
+
+        def generate(program: int):
+            output = self.client.channel.sender.invoke_failing(*coconet.CMD_GENERATE, (make_midi(program), 2))
+            results[program] = [midi.instruments[0].program for midi in output]
+
+        workers = [threading.Thread(target=generate, args=(program,)) for program in range(8)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+        self.assertEqual(results, {program: [program, program] for program in range(8)})
+
+    def test_unknown_command(self):
+        result = invoke_with_timeout(self.client.channel.sender, (40, 41))
+        self.assertIsInstance(result, parallel.CommandException)
+
+    def test_unencodable_value(self):
+        result = invoke_with_timeout(self.client.channel.sender, coconet.CMD_LOAD, object())
+        self.assertIsInstance(result, parallel.CommandException)
+
+    def test_invalid_parameters(self):
+        sender = self.client.channel.sender
+        for value in (None, (make_midi(0),), (make_midi(0), "2"), (make_midi(0), 0), ("midi", 1)):
+            result = invoke_with_timeout(sender, coconet.CMD_GENERATE, value)
+            self.assertIsInstance(result, parallel.CommandException)
+        self.assertEqual(len(sender.invoke_failing(*coconet.CMD_GENERATE, (make_midi(0), 1))), 1)
+
+    def test_invalid_frame_closes_connection(self):
+        sock = server._create_socket(self.server.address)
+        sock.connect(self.server.address)
+        payload = b"\x80\x04K\x01."  # a pickled value
+        sock.sendall(struct.pack("!IHI", 1, coconet.CMD_LOAD[0], len(payload)) + payload)
+        sock.settimeout(5)
+        self.assertEqual(sock.recv(1), b"")
+        sock.close()
+        self.assertEqual(self.client.channel.sender.invoke(*coconet.CMD_STATE), coconet.STATE_EMPTY)
+
+    def test_job_crash_fails_requests(self):
+        sender = self.client.channel.sender
+        result = invoke_with_timeout(sender, coconet.CMD_GENERATE, (make_midi(0), CRASH_BATCH_COUNT))
+        self.assertIsInstance(result, parallel.CommandException)
+        result = invoke_with_timeout(sender, coconet.CMD_STATE)
+        self.assertIsInstance(result, parallel.CommandException)
+
+    def test_disconnect_fails_outstanding_requests(self):
+        sender = self.client.channel.sender
+        result = []
+        worker = threading.Thread(
+            target=lambda: result.append(sender.invoke(*coconet.CMD_GENERATE, (make_midi(0), SLOW_BATCH_COUNT)))
+        )
+        worker.start()
+        time.sleep(0.3)
+        self.server.shutdown()
+        worker.join(10)
+        self.assertFalse(worker.is_alive())
+        self.assertIsInstance(result[0], parallel.CommandException)
+
+        result = invoke_with_timeout(sender, coconet.CMD_STATE)
+        self.assertIsInstance(result, parallel.CommandException)
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "Unix sockets are not available.")
+class UnixServerTest(ServerTest):
+    address = os.path.join(tempfile.gettempdir(), f"coconet-test-{os.getpid()}.sock")
+
+
+if __name__ == '__main__':
+    unittest.main()